@@ -13,19 +13,22 @@
 import os
 import sys
 from ast import parse
-sys.path.insert(0, os.path.abspath('../..'))
+
+sys.path.insert(0, os.path.abspath("../.."))
 
 
 # -- Project information -----------------------------------------------------
 
-project = 'IoTaWatt_Access'
-copyright = '2020-2024, Brendt Wohlberg'
-author = 'Brendt Wohlberg'
+project = "IoTaWatt_Access"
+copyright = "2020-2024, Brendt Wohlberg"
+author = "Brendt Wohlberg"
 
-with open('../../iotawatt_access.py') as f:
-    version = parse(next(filter(
-        lambda line: line.startswith('__version__'),
-        f))).body[0].value.s
+with open("../../iotawatt_access.py") as f:
+    version = (
+        parse(next(filter(lambda line: line.startswith("__version__"), f)))
+        .body[0]
+        .value.s
+    )
 release = version
 
 
@@ -63,7 +66,7 @@ autoclass_content = "both"
 
 
 # Add any paths that contain templates here, relative to this directory.
-templates_path = ['_templates']
+templates_path = ["_templates"]
 
 # List of patterns, relative to source directory, that match files and
 # directories to ignore when looking for source files.
@@ -76,14 +79,14 @@ exclude_patterns = []
 # The theme to use for HTML and HTML Help pages.  See the documentation for
 # a list of builtin themes.
 #
-html_theme = 'furo'
+html_theme = "furo"
 
 html_title = f"{project} {release}"
 
 # Add any paths that contain custom static files (such as style sheets) here,
 # relative to this directory. They are copied after the builtin static files,
 # so a file named "default.css" will overwrite the builtin "default.css".
-html_static_path = ['_static']
+html_static_path = ["_static"]
 
 
 def setup(app):
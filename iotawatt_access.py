@@ -4,8 +4,13 @@
 
 """Classes for accessing IotaWatt status and data via the Query API."""
 
+import hashlib
 import os
+import tempfile
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 from json import JSONDecodeError
 
 import numpy as np
@@ -13,47 +18,66 @@ import requests
 from dateutil.parser import parse
 from dateutil.tz import tzlocal, tzutc
 from requests import ConnectionError
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPDigestAuth
 from requests.exceptions import RequestException
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Exceptions indicating an error in parsing a JSON response
+if ijson is None:
+    _JSON_ERRORS = (JSONDecodeError,)
+else:
+    _JSON_ERRORS = (JSONDecodeError, ijson.JSONError)
 
 __version__ = "0.0.1.dev0"
 
+# Conversion factor from power to energy (in watt-hours) per sample
+_SAMPLE_HOURS = np.float32(5.0 / 3600.0)
 
+
+@lru_cache(maxsize=1)
 def device_login():
     """Get device URL, username, and password.
 
     Return device URL, username, and password from environment variables
     "IOTAWATT_URL", "IOTAWATT_USERNAME", and "IOTAWATT_PASSWORD"
     respectively. If not set, return defaults values
-    "http://iotawatt.local", "admin", and``None`` respectively.
+    "http://iotawatt.local", "admin", and``None`` respectively. The
+    environment is only read on the first call; call
+    ``device_login.cache_clear()`` to force it to be read again.
     """
-    if "IOTAWATT_URL" in os.environ:
-        url = os.environ["IOTAWATT_URL"]
-    else:
-        url = "http://iotawatt.local"
-    if "IOTAWATT_USERNAME" in os.environ:
-        user = os.environ["IOTAWATT_USERNAME"]
-    else:
-        user = "admin"
-    if "IOTAWATT_PASSWORD" in os.environ:
-        pwd = os.environ["IOTAWATT_PASSWORD"]
-    else:
-        pwd = None
+    url = os.environ.get("IOTAWATT_URL", "http://iotawatt.local")
+    user = os.environ.get("IOTAWATT_USERNAME", "admin")
+    pwd = os.environ.get("IOTAWATT_PASSWORD", None)
 
     return url, user, pwd
 
 
+@lru_cache(maxsize=1)
 def data_path():
     """Get path for data store.
 
     Return the data path from environment variable "IOTAWATT_DATA_PATH"
-    if set. Otherwise return default value "~/IotaWatt_Data".
+    if set. Otherwise return default value "~/IotaWatt_Data". The
+    environment is only read on the first call; call
+    ``data_path.cache_clear()`` to force it to be read again.
     """
-    if "IOTAWATT_DATA_PATH" in os.environ:
-        dpath = os.environ["IOTAWATT_DATA_PATH"]
-    else:
-        dpath = "~/IotaWatt_Data"
-    return dpath
+    return os.environ.get("IOTAWATT_DATA_PATH", "~/IotaWatt_Data")
 
 
 def str_to_datetime(timestr, utc=False):
@@ -67,7 +91,11 @@ def str_to_datetime(timestr, utc=False):
     Returns:
         datetime: A datetime object representation of the date/time
     """
-    dt = parse(timestr)
+    try:
+        # Fast path for ISO format strings
+        dt = datetime.fromisoformat(timestr)
+    except ValueError:
+        dt = parse(timestr)
     if dt.tzinfo is None:
         if utc:
             dt = dt.replace(tzinfo=tzutc())
@@ -127,6 +155,68 @@ def timestamp_to_str(ts, utc=False, notz=False):
     return dt.isoformat()
 
 
+def _reactive_power(v, w, a, scale=1.0):
+    """Compute reactive power from voltage, real power, and current.
+
+    Args:
+        v (numpy array): Voltage
+        w (numpy array): Real power
+        a (numpy array): Current
+        scale (float, optional): Scale factor applied to the result
+
+    Returns:
+        numpy array: Reactive power
+    """
+    # Ensure that the scale factor does not promote the result dtype
+    scale = np.result_type(v, w, a).type(scale)
+    if ne is not None:
+        return ne.evaluate("scale * sqrt((v * a) ** 2 - w * w)")
+    c = np.multiply(v, a)
+    np.square(c, out=c)
+    c -= np.square(w)
+    np.sqrt(c, out=c)
+    if scale != 1.0:
+        c *= scale
+    return c
+
+
+def _quantize(data, frcdig):
+    """Quantize data columns to 16 bit integers.
+
+    Each column is scaled by the largest power of ten, not exceeding
+    `10**frcdig`, for which all values of the column are representable
+    as 16 bit integers.
+
+    Args:
+        data (numpy array): Array of data to be quantized
+        frcdig (int): Maximum number of fractional digits to be retained
+
+    Returns:
+        tuple: Quantized data (numpy array of int16) and per-column scale
+        factors (numpy array of float32) by which the quantized data
+        should be multiplied to recover the original values
+
+    Raises:
+        ValueError: Data contains NaN values, or data column values too
+          large to be represented
+    """
+    if np.isnan(data).any():
+        raise ValueError("Data containing NaN values cannot be quantized")
+    imax = np.iinfo(np.int16).max
+    amax = np.abs(data).max(axis=0, initial=0)
+    digits = np.full(data.shape[1], int(frcdig))
+    for j in range(data.shape[1]):
+        while np.rint(amax[j] * 10.0 ** digits[j]) > imax:
+            if digits[j] == 0:
+                raise ValueError(
+                    "Data column %d (maximum %f) exceeds 16 bit integer range"
+                    % (j, amax[j])
+                )
+            digits[j] -= 1
+    q = np.rint(data * 10.0**digits).astype(np.int16, order="F")
+    return q, (10.0**-digits).astype(np.float32)
+
+
 def _list_check(lst, rowlen):
     """Check that all rows in a nested list have the required length.
 
@@ -138,11 +228,7 @@ def _list_check(lst, rowlen):
         None or int: None if all rows have required length, otherwise
            index of first row with incorrect length
     """
-    ret = None
-    for n, row in enumerate(lst):
-        if len(row) != rowlen:
-            ret = n
-    return ret
+    return next((n for n, row in enumerate(lst) if len(row) != rowlen), None)
 
 
 def _dict_get_str(d, key, fmt, cnv):
@@ -190,23 +276,30 @@ def dict_list_to_str(dl, keys=None, fmt=None, cnv=None):
     fdval = lambda d, key: _dict_get_str(d, key, fmt, cnv)
 
     ncol = len(keys)  # number of columns
-    colw = {k: len(str(k)) for k in keys}  # column widths
+    # String representations of all table values
+    rendered = [[fdval(d, k) for k in keys] for d in dl]
     # Column width is the maximum of key width and all value widths
-    for d in dl:
-        colw = {k: max(len(fdval(d, k)), colw[k]) for k in keys}
+    colw = [len(str(k)) for k in keys]  # column widths
+    for row in rendered:
+        for j, v in enumerate(row):
+            if len(v) > colw[j]:
+                colw[j] = len(v)
 
     # Construct table header row
-    vsep = "-" * (sum(colw.values()) + 2 * (ncol - 1)) + "\n"
-    s = vsep
-    s += "  ".join([k.capitalize().ljust(colw[k]) for k in keys]) + "\n"
-    s += vsep
+    vsep = "-" * (sum(colw) + 2 * (ncol - 1)) + "\n"
+    parts = [vsep]
+    parts.append(
+        "  ".join([k.capitalize().ljust(w) for k, w in zip(keys, colw)]) + "\n"
+    )
+    parts.append(vsep)
 
     # Construct table content
-    for d in dl:
-        s += "  ".join([fdval(d, k).ljust(colw[k]) for k in keys]) + "\n"
-    s += vsep
+    parts.extend(
+        "  ".join([v.ljust(w) for v, w in zip(row, colw)]) + "\n" for row in rendered
+    )
+    parts.append(vsep)
 
-    return s
+    return "".join(parts)
 
 
 def dict_to_str(d, fmt=None, cnv=None):
@@ -231,14 +324,14 @@ def dict_to_str(d, fmt=None, cnv=None):
     )  # max value length
     vsep = "-" * (klen + 2 + vlen) + "\n"  # separator bar
 
-    s = vsep
+    parts = [vsep]
     for k in d.keys():
         v = _dict_get_str(d, k, fmt, cnv)
-        s += k.ljust(klen) + ": " + v.ljust(vlen) + "\n"
+        parts.append(k.ljust(klen) + ": " + v.ljust(vlen) + "\n")
 
-    s += vsep
+    parts.append(vsep)
 
-    return s
+    return "".join(parts)
 
 
 class IotaWattAPI:
@@ -246,9 +339,12 @@ class IotaWattAPI:
 
     Attributes:
         auth (HTTPDigestAuth): Authentication for access to Query API
+        cache_dir (str or None): Directory for cached channel data
         channels (list): List of IotaWatt channel names
         inputs (list): List of IotaWatt input channel names
         outputs (list): List of IotaWatt output channel names
+        session (requests.Session): Persistent HTTP session used for
+          all queries
         url (str): URL for access to Query API
     """
 
@@ -259,6 +355,7 @@ class IotaWattAPI:
         pwd=None,
         debug=False,
         dbgfile="iotawatt_api_debug.log",
+        cache_dir=None,
     ):
         """Initialize IotaWattAPI object.
 
@@ -266,6 +363,13 @@ class IotaWattAPI:
             url (str, optional): IotaWatt device URL
             user (str, optional): IotaWatt API username
             pwd (None, optional): IotaWatt API password
+            debug (bool, optional): Flag indicating whether a transaction
+              log should be written for debugging purposes
+            dbgfile (str, optional): Filename of transaction log
+            cache_dir (str or None, optional): Directory in which data
+              downloaded by :meth:`get_channel_data` is cached, so that
+              repeated requests for the same data are served from disk.
+              Caching is disabled if None.
         """
         self.url = url
         if self.url[-1] != "/":
@@ -274,9 +378,22 @@ class IotaWattAPI:
             self.auth = None
         else:
             self.auth = HTTPDigestAuth(user, pwd)
+        # Reuse a single connection (and digest authentication state)
+        # across queries
+        self.session = requests.Session()
+        self.session.auth = self.auth
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
         self.debug = debug
         self.dbgfile = dbgfile
+        if cache_dir is None:
+            self.cache_dir = None
+        else:
+            self.cache_dir = os.path.expanduser(cache_dir)
+        # Debug log file object, opened on first write
+        self._dbgfp = None
 
         inout = self.get_channel_info()
         numout = len(self.get_status(stype="outputs"))
@@ -318,7 +435,15 @@ class IotaWattAPI:
             return []
 
     def get_channel_data(
-        self, begin, end, channels=None, interval=5, frcdig=3, retry=3, callback=None
+        self,
+        begin,
+        end,
+        channels=None,
+        interval=5,
+        frcdig=3,
+        retry=3,
+        callback=None,
+        compress=False,
     ):
         """Get recorded data from IotaWatt device.
 
@@ -334,6 +459,9 @@ class IotaWattAPI:
             retry (int, optional): Number of retries allowed
             callback (func or None, optional): Callback function
               supporting data download progress monitoring
+            compress (bool, optional): Flag indicating whether the
+              returned channel data should be quantized (see
+              :class:`IotaWattData`)
 
         Returns:
             IotaWattData: Channel data and metadata
@@ -355,8 +483,11 @@ class IotaWattAPI:
             + len(self.v_inputs) * 2 * (7 + frcdig)
             + len(channels) * 2 * (7 + frcdig)
         )
+        # Stream and incrementally parse responses when orjson, which is
+        # faster than ijson at this response size, is not available
+        stream = orjson is None and ijson is not None and not self.debug
         # Maximum response size in bytes
-        maxsize = 100000
+        maxsize = 1000000
         # Maximum number of rows allowed per query
         queryrows = maxsize // rowsize
 
@@ -364,83 +495,209 @@ class IotaWattAPI:
         tbegin = str_to_timestamp(begin)
         tend = str_to_timestamp(end)
 
+        # Return cached data if available
+        if self.cache_dir is None:
+            cache_file = None
+        else:
+            # Key string built from plain str values so that equal channel
+            # names give equal keys whatever their string type
+            keystr = "|".join(
+                [
+                    self.url,
+                    repr(float(tbegin)),
+                    repr(float(tend)),
+                    str(int(interval)),
+                    str(int(frcdig)),
+                    ",".join(map(str, channels)),
+                    str(bool(compress)),
+                ]
+            )
+            key = hashlib.blake2b(keystr.encode(), digest_size=16).hexdigest()
+            cache_file = os.path.join(self.cache_dir, key + ".npz")
+            try:
+                iwd = IotaWattData.load(cache_file)
+            except FileNotFoundError:
+                pass
+            except Exception as ex:
+                # Treat an unreadable cache file as a cache miss
+                warnings.warn(
+                    "Ignoring unreadable cache file %s: %s" % (cache_file, ex),
+                    RuntimeWarning,
+                )
+            else:
+                iwd.begin = begin
+                iwd.end = end
+                return iwd
+
         # Set t0 and t1 to point to start and end of time interval
         # for initial query
         t0 = tbegin
         t1 = min(tend, t0 + interval * queryrows)
         # Set number of retries for this value of t0
         t0retry = 0
-        cdat = None
-        # Repeat queries until start of current query interval reaches
-        # end of requested interval
-        while t0 < tend:
-            # Call status reporting callback function if defined
-            if callback is not None:
-                callback(tbegin, tend, t0, t1)
-            # Construct query and get response
-            query = (
-                "select=%s&begin=%10d&end=%10d&group=%ds&format=json&" "missing=skip"
-            ) % (select, t0, t1, interval)
-            json = self._query("query?" + query, retry=retry)
-            if len(json) == 0:
-                # If the request does not result in any errors but has
-                # zero length, assume that the corresponding data is
-                # missing from the device history
-                t0 = t1
-                t1 = min(tend, t0 + interval * queryrows)
-                continue
-            # Check JSON response list for rows with incorrect length
-            # (not clear why these are encountered occasionally)
-            rowidx = _list_check(json, len(datcol))
-            if rowidx is None:
-                # No row length errors
-                cblk = np.array(json)
-                t0 = t1
-                t0retry = 0
-            else:
-                # Row length error encountered
-                RuntimeWarning("Bad record received for time %d" % json[rowidx][0])
-                if rowidx > 0:
-                    # Row length error is not in first row: assume that
-                    # the preceding rows are valid and prepare to retry
-                    # starting at the problematic row
-                    cblk = np.array(json[0 : rowidx - 1])
-                    t0 = json[rowidx][0]
+        # Preallocate the array accumulating the full set of rows, using
+        # the number of sampling intervals in the requested time range as
+        # an upper bound on the number of rows, and maintain an index of
+        # the next row to be filled
+        nrows_max = int((tend - tbegin) // interval) + 1
+        cdat = np.empty((nrows_max, len(datcol)), dtype=np.float64)
+        cursor = 0
+        # List of blocks that do not fit in the preallocated array
+        blocks = []
+        # Query template, to be completed with the start and end times of
+        # each query interval. Any "%" in channel names must be escaped.
+        query_tmpl = (
+            "query?select=%s&begin=%%10d&end=%%10d&group=%ds&format=json&"
+            "missing=skip"
+        ) % (select.replace("%", "%%"), interval)
+        # Query for the time interval following the current one, issued in
+        # the background while the current response is being processed, as
+        # a tuple of interval start time, interval end time, and future
+        prefetch = None
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            # Repeat queries until start of current query interval reaches
+            # end of requested interval
+            while t0 < tend:
+                # Call status reporting callback function if defined
+                if callback is not None:
+                    callback(tbegin, tend, t0, t1)
+                # Get response, using the prefetched query if it is for the
+                # current interval
+                if prefetch is not None and prefetch[0:2] == (t0, t1):
+                    json = prefetch[2].result()
+                else:
+                    if prefetch is not None:
+                        # Discard the prefetched query, waiting for it to
+                        # complete if it is already running
+                        if not prefetch[2].cancel():
+                            prefetch[2].exception()
+                    json = self._query(
+                        query_tmpl % (t0, t1), retry=retry, stream=stream
+                    )
+                prefetch = None
+                # Start query for the following interval, which is the next
+                # one required unless the current response has errors
+                if t1 < tend:
+                    t2 = min(tend, t1 + interval * queryrows)
+                    prefetch = (
+                        t1,
+                        t2,
+                        executor.submit(
+                            self._query,
+                            query_tmpl % (t1, t2),
+                            retry=retry,
+                            stream=stream,
+                        ),
+                    )
+                if len(json) == 0:
+                    # If the request does not result in any errors but has
+                    # zero length, assume that the corresponding data is
+                    # missing from the device history
+                    t0 = t1
+                    t1 = min(tend, t0 + interval * queryrows)
+                    continue
+                # Check JSON response list for rows with incorrect length
+                # (not clear why these are encountered occasionally)
+                rowidx = _list_check(json, len(datcol))
+                if rowidx is None:
+                    # No row length errors
+                    cblk = np.asarray(json, dtype=np.float64)
+                    t0 = t1
                     t0retry = 0
                 else:
-                    # Row length error in in the first row: discard the
-                    # entire list of rows and prepare to retry with the
-                    # same starting time as the previous query
-                    cblk = None
-                    t0retry += 1
-            if cblk is None:
-                # Allow only a limited number of retries with the same
-                # value of t0
-                if t0retry > 2:
-                    raise RuntimeError(
-                        "Too many failures in accessing"
-                        " data block starting at time %d" % t0
+                    # Row length error encountered
+                    warnings.warn(
+                        "Bad record received for time %d" % json[rowidx][0],
+                        RuntimeWarning,
                     )
-            else:
-                # Set or extend the array accumulating the full set of
-                # rows obtained over multiple requests
-                if cdat is None:
-                    cdat = cblk
+                    if rowidx > 0:
+                        # Row length error is not in first row: assume that
+                        # the preceding rows are valid and prepare to retry
+                        # starting at the problematic row
+                        cblk = np.asarray(json[0:rowidx], dtype=np.float64)
+                        t0 = json[rowidx][0]
+                        t0retry = 0
+                    else:
+                        # Row length error in in the first row: discard the
+                        # entire list of rows and prepare to retry with the
+                        # same starting time as the previous query
+                        cblk = None
+                        t0retry += 1
+                if cblk is None:
+                    # Allow only a limited number of retries with the same
+                    # value of t0
+                    if t0retry > 2:
+                        raise RuntimeError(
+                            "Too many failures in accessing"
+                            " data block starting at time %d" % t0
+                        )
                 else:
-                    cdat = np.vstack((cdat, cblk))
-                # Update end of query interval
-                t1 = min(tend, t0 + interval * queryrows)
+                    # Copy the block into the array accumulating the full set
+                    # of rows obtained over multiple requests. If the estimated
+                    # row count is exceeded, set aside this and all subsequent
+                    # blocks to be appended once the download is complete.
+                    n = cblk.shape[0]
+                    if not blocks and cursor + n <= cdat.shape[0]:
+                        cdat[cursor : cursor + n] = cblk
+                        cursor += n
+                    else:
+                        blocks.append(cblk)
+                    # Update end of query interval
+                    t1 = min(tend, t0 + interval * queryrows)
+
+        cdat = cdat[:cursor]
+        if blocks:
+            cdat = np.concatenate([cdat] + blocks)
+
+        try:
+            iwd = IotaWattData(
+                begin,
+                end,
+                self.v_inputs,
+                channels,
+                frcdig,
+                cols=datcol[1:],
+                data=cdat,
+                compress=compress,
+            )
+        except ValueError as ex:
+            if not compress:
+                raise
+            # Return unquantized data rather than discarding the download
+            warnings.warn(
+                "Data could not be quantized (%s); returning unquantized data" % ex,
+                RuntimeWarning,
+            )
+            iwd = IotaWattData(
+                begin, end, self.v_inputs, channels, frcdig, cols=datcol[1:], data=cdat
+            )
+        # Cache the data unless the requested time interval extends into
+        # the future, in which case it may not be complete
+        if cache_file is not None and tend <= datetime.now().timestamp():
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Write to a temporary file and then move it into place so that
+            # an interrupted or concurrent save cannot leave a partial file
+            fd, tmpfile = tempfile.mkstemp(suffix=".npz", dir=self.cache_dir)
+            os.close(fd)
+            try:
+                iwd.save(tmpfile)
+                os.replace(tmpfile, cache_file)
+            except BaseException:
+                os.remove(tmpfile)
+                raise
 
-        return IotaWattData(
-            begin, end, self.v_inputs, channels, frcdig, cols=datcol[1:], data=cdat
-        )
+        return iwd
 
-    def _query(self, query, retry=3):
+    def _query(self, query, retry=3, stream=False):
         """Send query via device API and get response.
 
         Args:
             query (str): Query string
             retry (int, optional): Number of retries allowed
+            stream (bool, optional): Flag indicating whether a response
+              consisting of a JSON list should be parsed incrementally
+              as it is received. Ignored if ijson is not installed or
+              when writing a transaction log.
 
         Returns:
             dict: JSON formatted response
@@ -453,14 +710,16 @@ class IotaWattAPI:
         req = self.url + query
         if self.debug:
             self._debug_write("REQUEST\n%s\n" % req)
+        stream = stream and ijson is not None and not self.debug
 
         response = None
         for reqtry in range(retry):
             jsonfail = False
+            readfail = False
             try:
-                response = requests.get(req, auth=self.auth)
+                response = self.session.get(req, stream=stream)
             except RequestException as ex:
-                RuntimeWarning(ex)
+                warnings.warn(str(ex), RuntimeWarning)
                 continue
             if self.debug:
                 self._debug_write("STATUS CODE: %d\n" % response.status_code)
@@ -468,32 +727,54 @@ class IotaWattAPI:
                 if self.debug:
                     self._debug_write("RESPONSE\n%s\n" % response.text)
                 try:
-                    json = response.json()
-                except JSONDecodeError:
+                    if stream:
+                        response.raw.decode_content = True
+                        json = next(ijson.items(response.raw, "", use_float=True))
+                        if not isinstance(json, list):
+                            raise ijson.JSONError("Streamed response is not a list")
+                    elif orjson is None:
+                        json = response.json()
+                    else:
+                        json = orjson.loads(response.content)
+                except (Urllib3HTTPError, RequestException) as ex:
+                    # Connection failure while reading a streamed response
+                    readfail = True
+                    warnings.warn(str(ex), RuntimeWarning)
+                    continue
+                except _JSON_ERRORS:  # JSONDecodeError also raised by orjson
                     jsonfail = True
-                    RuntimeWarning("JSON parse error")
+                    warnings.warn("JSON parse error", RuntimeWarning)
                     if self.debug:
                         self._debug_write("JSON PARSE ERROR\n")
                 else:
                     if self.debug:
                         self._debug_write("JSON PARSE SUCCESS\n")
                     break
+                finally:
+                    # A streamed response holds its connection until the
+                    # body is read or the response is closed
+                    if stream:
+                        response.close()
             else:
-                RuntimeWarning("Connection error code %d" % response.status_code)
-
-        if reqtry >= retry:
-            raise RuntimeError(
-                "Maximum number of retries exceeded (%d tries)" % (reqtry + 1)
-            )
-        if response is None:
-            raise RunTimeError("Unrecognized failure")
+                warnings.warn(
+                    "Connection error code %d" % response.status_code, RuntimeWarning
+                )
+                if stream:
+                    # Read the (short) error body so that the connection can
+                    # be reused
+                    response.content
+                    response.close()
+
+        if response is None or readfail:
+            raise RuntimeError("Maximum number of retries exceeded (%d tries)" % retry)
         if response.status_code != 200:
             raise ConnectionError("Connection error code %d" % response.status_code)
         if jsonfail:
-            raise RuntimeError(
-                "Error parsing JSON response (length %d) to "
-                "query %s" % (len(response.text), query)
-            )
+            if stream:
+                resp = "streamed JSON response"
+            else:
+                resp = "JSON response (length %d)" % len(response.text)
+            raise RuntimeError("Error parsing %s to query %s" % (resp, query))
 
         if self.debug:
             self._debug_write("JSON\n%s\n\n" % json)
@@ -506,9 +787,23 @@ class IotaWattAPI:
         Args:
             text (str): Text to add to transaction log
         """
-        f = open(self.dbgfile, "a+")
-        f.write(text)
-        f.close()
+        if self._dbgfp is None:
+            # Line buffered so that the log is up to date if a download
+            # hangs or the process is killed
+            self._dbgfp = open(self.dbgfile, "a", buffering=1)
+        self._dbgfp.write(text)
+
+    def close(self):
+        """Close the debug log file and the HTTP session."""
+        if getattr(self, "_dbgfp", None) is not None:
+            self._dbgfp.close()
+            self._dbgfp = None
+        if getattr(self, "session", None) is not None:
+            self.session.close()
+
+    def __del__(self):
+        """Release resources when the object is deleted."""
+        self.close()
 
 
 class IotaWattData:
@@ -518,15 +813,34 @@ class IotaWattData:
         begin (str): Start date/time of channel data
         vchannels (list): List of voltage channel names
         ichannels (list): List of current/power channel names
-        data (numpy array): Array of channel data
+        data (numpy array): Array of channel data, with columns in the
+          order of voltage channel volts and hertz values followed by
+          current/power channel watts and amps values
         end (str): End date/time of channel data
         frcdig (int): Number of fractional digits in numeric values
         time (numpy array): Array of sample times as Unix timestamps
+          (int64)
+        time_dt64 (numpy array): View of `time` as datetime64 values
+        scale (numpy array or None): Per-column scale factors by which
+          `data` should be multiplied if it is quantized, otherwise None
         units (str): Units for channel data
+        volts, hz, watts, amps (numpy array): Columns of `data` for each
+          quantity, with one column per channel. These are views of
+          `data` if it is not quantized, and dequantized copies if it is.
     """
 
     def __init__(
-        self, begin, end, vchannels, ichannels, frcdig, cols=None, data=None, time=None
+        self,
+        begin,
+        end,
+        vchannels,
+        ichannels,
+        frcdig,
+        cols=None,
+        data=None,
+        time=None,
+        scale=None,
+        compress=False,
     ):
         """Initialize IotaWattData object.
 
@@ -539,6 +853,12 @@ class IotaWattData:
             cols (list or None, optional): List of data column descriptions
             data (numpy array or None, optional): Array of channel data
             time (numpy array or None, optional): Array of sample times
+            scale (numpy array or None, optional): Per-column scale
+              factors if `data` is quantized
+            compress (bool, optional): Flag indicating whether `data`
+              should be quantized to 16 bit integers to reduce memory
+              and disk usage. Fractional digits are discarded from
+              columns with values too large to retain all of them.
         """
         self.begin = begin
         self.end = end
@@ -546,12 +866,70 @@ class IotaWattData:
         self.ichannels = ichannels
         self.frcdig = frcdig
         self.cols = cols
+        # Maps from channel names to channel indices
+        self._vchan_idx = {n: i for i, n in enumerate(self.vchannels)}
+        self._ichan_idx = {n: i for i, n in enumerate(self.ichannels)}
+        self.scale = scale
         if time is None:
-            self.time = data[:, 0].astype(int)
-            self.data = data[:, 1:].astype(np.float32)
+            self.time = data[:, 0].astype(np.int64)
+            # Store in column-major order so that the data for each
+            # channel is contiguous in memory
+            self.data = np.asfortranarray(data[:, 1:], dtype=np.float32)
         else:
-            self.time = time
+            self.time = np.asarray(time, dtype=np.int64)
             self.data = data
+        if self.time.shape != (self.data.shape[0],):
+            raise ValueError(
+                "Time array shape %s is inconsistent with data array shape %s"
+                % (self.time.shape, self.data.shape)
+            )
+        if compress and self.scale is None:
+            self.data, self.scale = _quantize(self.data, frcdig)
+
+    def _columns(self, start, stop):
+        """Get channel data columns `start` to `stop`, dequantized if necessary.
+
+        Args:
+            start (int): Index of first column
+            stop (int): Index of column following the last column
+
+        Returns:
+            numpy array: Array of channel data columns
+        """
+        c = self.data[:, start:stop]
+        if self.scale is not None:
+            c = c * self.scale[start:stop]
+        return c
+
+    @property
+    def time_dt64(self):
+        """numpy array: Sample times as a datetime64 array (UTC)."""
+        return self.time.view("datetime64[s]")
+
+    @property
+    def volts(self):
+        """numpy array: Voltage channel volts data."""
+        return self._columns(0, len(self.vchannels))
+
+    @property
+    def hz(self):
+        """numpy array: Voltage channel hertz data."""
+        nv = len(self.vchannels)
+        return self._columns(nv, 2 * nv)
+
+    @property
+    def watts(self):
+        """numpy array: Current/power channel watts data."""
+        nv = len(self.vchannels)
+        return self._columns(2 * nv, 2 * nv + len(self.ichannels))
+
+    @property
+    def amps(self):
+        """numpy array: Current/power channel amps data."""
+        nv = len(self.vchannels)
+        return self._columns(
+            2 * nv + len(self.ichannels), 2 * (nv + len(self.ichannels))
+        )
 
     def get_channel_data(self, name, units):
         """Get data from channel `name` in units `units`.
@@ -562,71 +940,101 @@ class IotaWattData:
               for voltage channels and 'watts', 'amps', 'wh', 'va', 'var',
               'varh', 'pf' for current/power channels.
         """
-        if name not in self.vchannels and name not in self.ichannels:
+        if name not in self._vchan_idx and name not in self._ichan_idx:
             raise ValueError("No data for channel %s" % name)
-        if name in self.vchannels:
+        if name in self._vchan_idx:
             # Voltage channel selected
             if units not in ["volts", "hertz"]:
                 raise ValueError("Unrecognized units %s" % units)
+            idx = self._vchan_idx[name]
+            nv = len(self.vchannels)
             if units == "volts":
-                c = self.data[:, 0]
+                c = self._columns(idx, idx + 1)[:, 0]
             else:
-                c = self.data[:, 1]
+                c = self._columns(nv + idx, nv + idx + 1)[:, 0]
         else:
             # Current/power channel selected
             if units not in ["watts", "amps", "wh", "va", "var", "varh", "pf"]:
                 raise ValueError("Unrecognized units %s" % units)
-            idx = self.ichannels.index(name)
-            v = self.data[:, 0]
-            w = self.data[:, idx + 2]
-            a = self.data[:, idx + len(self.ichannels) + 2]
+            idx = self._ichan_idx[name]
+            nv = len(self.vchannels)
+            ni = len(self.ichannels)
+            v = self._columns(0, 1)[:, 0]
+            w = self._columns(2 * nv + idx, 2 * nv + idx + 1)[:, 0]
+            a = self._columns(2 * nv + ni + idx, 2 * nv + ni + idx + 1)[:, 0]
             if units == "watts":
                 c = w
             elif units == "amps":
                 c = a
             elif units == "wh":
-                c = w * (5.0 / 3600.0)
+                c = np.multiply(w, _SAMPLE_HOURS)
             elif units == "va":
-                c = v * a
+                c = np.multiply(v, a)
             elif units == "var":
-                c = np.sqrt((v * a) ** 2 - w**2)
+                c = _reactive_power(v, w, a)
             elif units == "varh":
-                vah = v * a * (5.0 / 3600.0)
-                wh = w * (5.0 / 3600.0)
-                c = np.sqrt(vah**2 - wh**2)
+                c = _reactive_power(v, w, a, _SAMPLE_HOURS)
             else:  # units == 'pf'
-                c = w / (v * a)
+                c = np.multiply(v, a)
+                np.divide(w, c, out=c)
         return c
 
-    def save(self, filename):
-        """Save data in numpy NPZ format.
+    def save(self, filename, mmap=False):
+        """Save data in compressed numpy NPZ format.
 
         Args:
-            filename (str): Filename
+            filename (str): Filename, or directory name if `mmap` is True
+            mmap (bool, optional): Flag indicating whether each array
+              should be saved in a separate NPY format file in directory
+              `filename`, allowing it to be memory-mapped when loaded
         """
-        np.savez(
-            filename,
+        arrays = dict(
             time=self.time,
             data=self.data,
-            cols=self.cols,
+            cols=np.asarray(self.cols, dtype=str),
             begin=self.begin,
             end=self.end,
-            vchannels=self.vchannels,
-            ichannels=self.ichannels,
+            vchannels=np.asarray(self.vchannels, dtype=str),
+            ichannels=np.asarray(self.ichannels, dtype=str),
             frcdig=self.frcdig,
         )
+        if self.scale is not None:
+            arrays["scale"] = self.scale
+        if mmap:
+            os.makedirs(filename, exist_ok=True)
+            for key, val in arrays.items():
+                np.save(os.path.join(filename, key + ".npy"), val)
+            # Remove scale factors left by a previous save of quantized data
+            scale_file = os.path.join(filename, "scale.npy")
+            if self.scale is None and os.path.exists(scale_file):
+                os.remove(scale_file)
+        else:
+            np.savez_compressed(filename, **arrays)
 
     @classmethod
-    def load(cls, filename):
+    def load(cls, filename, mmap=False):
         """Load data from numpy NPZ format file.
 
         Args:
-            filename (str): Filename
+            filename (str): Filename, or directory name if `mmap` is True
+            mmap (bool, optional): Flag indicating whether data should be
+              memory-mapped from a directory written by :meth:`save` with
+              `mmap` True, so that it is only read from disk as accessed
 
         Returns:
             IotaWattData : Object data retrieved from file
         """
-        npz = np.load(filename)
+        if mmap:
+            keys = ["time", "data", "cols", "begin", "end"]
+            keys += ["vchannels", "ichannels", "frcdig"]
+            if os.path.exists(os.path.join(filename, "scale.npy")):
+                keys.append("scale")
+            npz = {
+                key: np.load(os.path.join(filename, key + ".npy"), mmap_mode="r")
+                for key in keys
+            }
+        else:
+            npz = np.load(filename)
         return cls(
             npz["begin"].item(),
             npz["end"].item(),
@@ -636,4 +1044,5 @@ class IotaWattData:
             list(npz["cols"]),
             npz["data"],
             npz["time"],
+            npz.get("scale"),
         )
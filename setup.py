@@ -38,6 +38,7 @@ setup(
     install_requires=["python-dateutil", "requests", "numpy", "matplotlib"],
     extras_require={
         "tests": ["pytest"],
+        "fast": ["orjson", "ijson", "numexpr"],
         "docs": [
             "sphinx",
             "sphinxcontrib-napoleon",
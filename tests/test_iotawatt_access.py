@@ -1,3 +1,11 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import numpy as np
+import pytest
+import requests
+
 import iotawatt_access as iw
 
 
@@ -13,3 +21,334 @@ def test_time_conv_utc():
     ts = iw.str_to_timestamp(str0, utc=True)
     str1 = iw.timestamp_to_str(ts, utc=True, notz=True)
     assert str0 == str1
+
+
+def test_device_login(monkeypatch):
+    monkeypatch.setenv("IOTAWATT_URL", "http://example.local")
+    monkeypatch.delenv("IOTAWATT_USERNAME", raising=False)
+    monkeypatch.delenv("IOTAWATT_PASSWORD", raising=False)
+    iw.device_login.cache_clear()
+    assert iw.device_login() == ("http://example.local", "admin", None)
+    monkeypatch.setenv("IOTAWATT_URL", "http://other.local")
+    assert iw.device_login()[0] == "http://example.local"
+    iw.device_login.cache_clear()
+    assert iw.device_login()[0] == "http://other.local"
+    iw.device_login.cache_clear()
+
+
+def test_dict_list_to_str():
+    dl = [
+        {"id": "Current", "size": 123456, "interval": 5, "firstkey": 1.5},
+        {"id": "History", "size": 7, "interval": 60, "firstkey": 22.25},
+    ]
+    s = iw.dict_list_to_str(dl, fmt={"size": "8d"}, cnv={"firstkey": lambda x: 2 * x})
+    assert s == (
+        "-------------------------------------\n"
+        "Id       Size      Interval  Firstkey\n"
+        "-------------------------------------\n"
+        "Current    123456  5         3.0     \n"
+        "History         7  60        44.5    \n"
+        "-------------------------------------\n"
+    )
+
+
+def test_dict_to_str():
+    d = {"ssid": "home", "rssi": -61.5, "connecttime": 3}
+    s = iw.dict_to_str(d, fmt={"rssi": ".1f"}, cnv={"connecttime": lambda x: x + 1})
+    assert s == (
+        "------------------\n"
+        "ssid       : home \n"
+        "rssi       : -61.5\n"
+        "connecttime: 4    \n"
+        "------------------\n"
+    )
+
+
+def test_list_check():
+    assert iw._list_check([[1, 2], [3, 4]], 2) is None
+    assert iw._list_check([[1, 2], [3], [4, 5], [6]], 2) == 1
+    assert iw._list_check([], 2) is None
+
+
+def _data():
+    t = 1704153600 + 5 * np.arange(10)
+    v = np.full(10, 120.0)
+    hz = np.full(10, 60.0)
+    w = np.stack((100.0 + np.arange(10), np.full(10, 50.0)), axis=1)
+    a = np.stack((np.full(10, 1.0), np.full(10, 0.5)), axis=1)
+    data = np.column_stack((t, v, hz, w, a))
+    cols = ["V.volts.d3", "V.hz.d3", "A.watts.d3", "B.watts.d3"]
+    cols += ["A.amps.d3", "B.amps.d3"]
+    return iw.IotaWattData(
+        "2024-01-02T00:00:00", "2024-01-02T00:01:00", ["V"], ["A", "B"], 3, cols, data
+    )
+
+
+def test_data_save_load(tmp_path):
+    d0 = _data()
+    for mmap in (False, True):
+        fname = str(tmp_path / ("data" if mmap else "data.npz"))
+        d0.save(fname, mmap=mmap)
+        d1 = iw.IotaWattData.load(fname, mmap=mmap)
+        assert d1.begin == d0.begin
+        assert d1.ichannels == d0.ichannels
+        assert d1.cols == d0.cols
+        assert np.array_equal(d1.time, d0.time)
+        assert np.array_equal(
+            d1.get_channel_data("A", "watts"), d0.get_channel_data("A", "watts")
+        )
+    # Saving unquantized data over quantized data must not leave stale
+    # scale factors
+    fname = str(tmp_path / "requant")
+    dq = iw.IotaWattData(
+        d0.begin,
+        d0.end,
+        d0.vchannels,
+        d0.ichannels,
+        3,
+        d0.cols,
+        np.column_stack((d0.time, d0.data)),
+        compress=True,
+    )
+    dq.save(fname, mmap=True)
+    d0.save(fname, mmap=True)
+    d1 = iw.IotaWattData.load(fname, mmap=True)
+    assert d1.scale is None
+    assert np.array_equal(d1.watts, d0.watts)
+
+
+def test_data_compress(tmp_path):
+    d0 = _data()
+    d1 = iw.IotaWattData(
+        d0.begin,
+        d0.end,
+        d0.vchannels,
+        d0.ichannels,
+        3,
+        d0.cols,
+        np.column_stack((d0.time, d0.data)),
+        compress=True,
+    )
+    assert d1.data.dtype == np.int16
+    for units in ("watts", "amps", "var", "pf"):
+        assert np.allclose(
+            d1.get_channel_data("A", units), d0.get_channel_data("A", units), rtol=1e-3
+        )
+    assert np.allclose(d1.amps, d0.amps)
+    # Data that cannot be quantized
+    for val in (np.nan, 40000.0):
+        data = np.column_stack((d0.time, d0.data))
+        data[3, 4] = val
+        with pytest.raises(ValueError):
+            iw.IotaWattData(
+                d0.begin,
+                d0.end,
+                d0.vchannels,
+                d0.ichannels,
+                3,
+                d0.cols,
+                data,
+                compress=True,
+            )
+    fname = str(tmp_path / "data.npz")
+    d1.save(fname)
+    d2 = iw.IotaWattData.load(fname)
+    assert np.array_equal(d2.watts, d1.watts)
+
+
+def test_str_to_datetime():
+    dt0 = iw.str_to_datetime("2024-01-02T10:05:01", utc=True)
+    dt1 = iw.str_to_datetime("Jan 2 2024 10:05:01", utc=True)
+    assert dt0 == dt1
+    assert dt0.utcoffset().total_seconds() == 0
+
+
+def test_data_time():
+    d = _data()
+    assert d.time.dtype == np.int64
+    assert d.time_dt64[0] == np.datetime64("2024-01-02T00:00:00")
+    assert np.sum(d.time_dt64 >= np.datetime64("2024-01-02T00:00:30")) == 4
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # Number of connections accepted
+    connections = 0
+
+    def setup(self):
+        super().setup()
+        type(self).connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        body = json.dumps([[t, 1.5] for t in range(1000)]).encode()
+        if "object" in self.path:
+            body = b'{"error": "unknown"}'
+        self.send_response(500 if "error" in self.path else 200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if "truncated" in self.path:
+            self.wfile.write(body[:100])
+            self.close_connection = True
+        else:
+            self.wfile.write(body)
+
+
+def test_query_stream():
+    pytest.importorskip("ijson")
+    srv = HTTPServer(("127.0.0.1", 0), _Handler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    api = object.__new__(iw.IotaWattAPI)
+    api.url = "http://127.0.0.1:%d/" % srv.server_port
+    api.debug = False
+    api.session = requests.Session()
+    try:
+        assert len(api._query("query", stream=True)) == 1000
+        with pytest.warns(RuntimeWarning):
+            with pytest.raises(RuntimeError, match="retries exceeded"):
+                api._query("truncated", stream=True)
+        with pytest.warns(RuntimeWarning), pytest.raises(RuntimeError):
+            api._query("object", stream=True)
+        # Unread error responses must not leak connections
+        _Handler.connections = 0
+        for _ in range(3):
+            with pytest.warns(RuntimeWarning):
+                with pytest.raises(requests.ConnectionError):
+                    api._query("error", stream=True)
+        assert _Handler.connections <= 1
+    finally:
+        api.session.close()
+        srv.shutdown()
+
+
+class _StubAPI(iw.IotaWattAPI):
+    """IotaWattAPI with device queries replaced by synthetic responses."""
+
+    def __init__(self, bad=None, inclusive=False, cache_dir=None, wfactor=1.0):
+        self.url = "http://stub/"
+        self.debug = False
+        self.cache_dir = cache_dir
+        self.v_inputs = ["V"]
+        self.i_inputs = ["A", "B"]
+        self.outputs = []
+        # Map from sample time to number of responses in which the row for
+        # that time should be truncated
+        self.bad = dict(bad or {})
+        # Flag indicating whether responses include a row for the query
+        # end time
+        self.inclusive = inclusive
+        # Factor by which the power values of each row are scaled
+        self.wfactor = wfactor
+        # Start and end times of all queries
+        self.queries = []
+
+    def _query(self, query, retry=3, stream=False):
+        params = dict(p.split("=") for p in query.split("?", 1)[1].split("&"))
+        t0, t1 = int(params["begin"]), int(params["end"])
+        self.queries.append((t0, t1))
+        # Number of current/power channels selected
+        nchan = (params["select"].count(",") - 2) // 2
+        rows = []
+        for t in range(t0, t1 + 1 if self.inclusive else t1, 5):
+            w = self.wfactor * (t % 1000)
+            row = [t, 120.0, 60.0] + [w] * nchan + [1.0] * nchan
+            if self.bad.get(t, 0) > 0:
+                self.bad[t] -= 1
+                row = row[0:3]
+            rows.append(row)
+        return rows
+
+
+def _check_download(d, tbegin, tend):
+    assert np.array_equal(d.time, np.arange(tbegin, tend, 5))
+    assert np.array_equal(d.get_channel_data("A", "watts"), d.time % 1000)
+
+
+def test_get_channel_data_cache(tmp_path):
+    begin, end = "2024-01-02T00:00:00", "2024-01-02T06:00:00"
+    tbegin, tend = int(iw.str_to_timestamp(begin)), int(iw.str_to_timestamp(end))
+    api = _StubAPI(cache_dir=str(tmp_path))
+    _check_download(api.get_channel_data(begin, end), tbegin, tend)
+    nquery = len(api.queries)
+    assert nquery > 0
+    assert len(list(tmp_path.glob("*.npz"))) == 1
+    # Cache hit, including for channel names of numpy string type
+    d = api.get_channel_data(begin, end, channels=list(np.array(["A", "B"])))
+    _check_download(d, tbegin, tend)
+    assert len(api.queries) == nquery
+    # Cache miss for a different channel selection
+    api.get_channel_data(begin, end, channels=["A"])
+    assert len(api.queries) > nquery
+    assert len(list(tmp_path.glob("*.npz"))) == 2
+    # Unreadable cache file treated as a miss and replaced
+    for f in tmp_path.glob("*.npz"):
+        f.write_bytes(b"truncated")
+    nquery = len(api.queries)
+    with pytest.warns(RuntimeWarning):
+        _check_download(api.get_channel_data(begin, end), tbegin, tend)
+    assert len(api.queries) > nquery
+    nquery = len(api.queries)
+    _check_download(api.get_channel_data(begin, end), tbegin, tend)
+    assert len(api.queries) == nquery
+    # No caching of data for an interval extending into the future
+    api.get_channel_data("2999-01-02T00:00:00", "2999-01-02T00:10:00")
+    assert len(list(tmp_path.glob("*"))) == 2
+
+
+def test_debug_write(tmp_path):
+    api = object.__new__(iw.IotaWattAPI)
+    api.dbgfile = str(tmp_path / "debug.log")
+    api._dbgfp = None
+    api._debug_write("REQUEST\nquery\n")
+    # Entries must reach the file without the log being closed
+    assert (tmp_path / "debug.log").read_text() == "REQUEST\nquery\n"
+    api.close()
+
+
+def test_get_channel_data():
+    begin, end = "2024-01-02T00:00:00", "2024-01-07T00:00:00"
+    tbegin, tend = int(iw.str_to_timestamp(begin)), int(iw.str_to_timestamp(end))
+    # Clean download
+    api = _StubAPI()
+    _check_download(api.get_channel_data(begin, end), tbegin, tend)
+    assert len(api.queries) > 2
+    # Start time of the second query, the first to be prefetched
+    t2 = api.queries[1][0]
+    # Bad row within a block and at the start of a block, for both the
+    # first block and a prefetched block
+    for t in (tbegin + 500, tbegin, t2 + 500, t2):
+        api = _StubAPI(bad={t: 1})
+        with pytest.warns(RuntimeWarning):
+            d = api.get_channel_data(begin, end)
+        _check_download(d, tbegin, tend)
+    # Repeated bad row at the start of a block
+    with pytest.warns(RuntimeWarning), pytest.raises(RuntimeError):
+        _StubAPI(bad={t2: 5}).get_channel_data(begin, end)
+    # Channel name containing a format character
+    api = _StubAPI()
+    api.i_inputs = ["A%B", "B"]
+    d = api.get_channel_data(begin, end)
+    assert np.array_equal(d.time, np.arange(tbegin, tend, 5))
+    # More rows than estimated from the time interval, as occurs if the
+    # end of each query interval is included in the response
+    d = _StubAPI(inclusive=True).get_channel_data(begin, end)
+    assert d.time.shape[0] > (tend - tbegin) // 5 + 1
+    assert np.all(np.diff(d.time) >= 0)
+    assert np.array_equal(np.unique(d.time), np.arange(tbegin, tend + 1, 5))
+    assert np.array_equal(d.get_channel_data("A", "watts"), d.time % 1000)
+
+
+def test_get_channel_data_compress():
+    begin, end = "2024-01-02T00:00:00", "2024-01-02T06:00:00"
+    tbegin, tend = int(iw.str_to_timestamp(begin)), int(iw.str_to_timestamp(end))
+    d = _StubAPI().get_channel_data(begin, end, compress=True)
+    assert d.data.dtype == np.int16
+    _check_download(d, tbegin, tend)
+    # Power values too large to be quantized: unquantized data returned
+    with pytest.warns(RuntimeWarning):
+        d = _StubAPI(wfactor=100.0).get_channel_data(begin, end, compress=True)
+    assert d.scale is None
+    assert np.array_equal(d.get_channel_data("A", "watts"), 100.0 * (d.time % 1000))